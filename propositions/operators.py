@@ -7,108 +7,234 @@
 """Syntactic conversion of propositional formulas to use only specific sets of
 operators."""
 
+from array import array
+from functools import wraps
+from typing import Callable, Dict, List, Mapping, NamedTuple, Optional, \
+    Sequence, Tuple, cast
+from weakref import ref
+
 from propositions.syntax import *
+from propositions.syntax import _postorder
 from propositions.semantics import *
 
+def _formula(root: str, first: Optional[Formula] = None,
+             second: Optional[Formula] = None) -> Formula:
+    # Before building a node, simplify away double negations (in each of the
+    # forms that negation takes in the conversions below) and conjunctions or
+    # disjunctions of a formula with itself, returning an existing subformula
+    # instead. This keeps the output of the conversions smaller, and only ever
+    # removes operators.
+    if root == '~':
+        if first.root == '~':
+            return first.first
+    elif root == '&' or root == '|':
+        if first is second:
+            return first
+    elif root == '-&':
+        if first is second and first.root == '-&' and \
+           first.first is first.second:
+            return first.first
+    elif root == '->':
+        if second.root == 'F' and first.root == '->' and \
+           first.second.root == 'F':
+            return first.first
+    return Formula(root, first, second)
+
+#: Integer opcodes of the roots of flattened formulas. Operators come first, so
+#: that the arity of a node can be read off its opcode by a single comparison.
+_NOT, _AND, _OR, _IMPLIES, _XOR, _IFF, _NAND, _NOR, _TRUE, _FALSE, \
+    _VARIABLE = range(11)
+
+_OPCODES: Mapping[str, int] = {
+    '~': _NOT, '&': _AND, '|': _OR, '->': _IMPLIES, '+': _XOR, '<->': _IFF,
+    '-&': _NAND, '-|': _NOR, 'T': _TRUE, 'F': _FALSE}
+
+def _flatten(formula: Formula) -> Tuple[List[Formula], array, array, array]:
+    # Lists the distinct subformulas of the given formula in post-order, as
+    # _postorder does, along with the opcode of the root of each subformula
+    # and the positions in that list of its first and second operands.
+    nodes, opcodes, firsts, seconds = _postorder(formula, _OPCODES, _VARIABLE)
+    return nodes, array('b', opcodes), array('i', firsts), array('i', seconds)
+
+_TRUE_FORMULA = Formula('T')
+_FALSE_FORMULA = Formula('F')
+
+#: A function that builds the conversion of a formula whose root is an
+#: operator from the already converted operands of that formula (the second of
+#: which is ``None`` for a unary operator).
+_Rewrite = Callable[[Formula, Optional[Formula]], Formula]
+
+def _compile_rewrite(template: str) -> _Rewrite:
+    # Generates, once, a straight-line function that builds the given template
+    # formula with its variables 'p' and 'q' replaced by the function's two
+    # arguments. Each distinct subformula of the template is built only once,
+    # even if it occurs several times in the template, and constants are not
+    # built at all but taken from the prebuilt ones below.
+    names: Dict[str, str] = {'p': 'p', 'q': 'q', 'T': 'true', 'F': 'false'}
+    lines: List[str] = []
+    def emit(formula: Formula) -> str:
+        key = str(formula)
+        if key not in names:
+            assert is_unary(formula.root) or is_binary(formula.root)
+            arguments = [repr(formula.root), emit(formula.first)]
+            if is_binary(formula.root):
+                arguments.append(emit(formula.second))
+            names[key] = 'node' + str(len(lines))
+            lines.append('    ' + names[key] + ' = _formula(' +
+                         ', '.join(arguments) + ')\n')
+        return names[key]
+    result = emit(Formula.parse(template))
+    source = 'def rewrite(p, q):\n' + ''.join(lines) + \
+             '    return ' + result + '\n'
+    namespace = {'_formula': _formula, 'true': _TRUE_FORMULA,
+                 'false': _FALSE_FORMULA}
+    exec(compile(source, '<rewrite ' + template + '>', 'exec'), namespace)
+    return namespace['rewrite']
+
+def _compile_rewrites(templates: Mapping[str, str]) -> Sequence[_Rewrite]:
+    # Returns the compiled rewrites indexed by the opcodes of their operators.
+    rewrites: List[Optional[_Rewrite]] = [None] * (_NOR + 1)
+    for operator, template in templates.items():
+        rewrites[_OPCODES[operator]] = _compile_rewrite(template)
+    assert None not in rewrites
+    return cast(List[_Rewrite], rewrites)
+
+#: The constants and rewrites that define a conversion, indexed by opcode.
+_Conversion = Tuple[Mapping[int, Formula], Sequence[_Rewrite]]
+
+def _convert_all(formula: Formula,
+                 conversions: Sequence[_Conversion]) -> List[Formula]:
+    # A single linear sweep over the flattened formula that performs all given
+    # conversions side by side: the operands of each node are converted before
+    # the node itself, and a subformula that is shared (as the same object) by
+    # several parents is converted only once.
+    nodes, opcodes, firsts, seconds = _flatten(formula)
+    converted: List[List[Formula]] = [[] for _ in conversions]
+    steps = [(constants, rewrites, results, results.append)
+             for (constants, rewrites), results in zip(conversions, converted)]
+    for node, opcode, first, second in zip(nodes, opcodes, firsts, seconds):
+        for constants, rewrites, results, append in steps:
+            if opcode <= _NOR:
+                append(rewrites[opcode](results[first],
+                                        results[second] if second >= 0
+                                        else None))
+            elif opcode == _VARIABLE:
+                append(node)
+            else:
+                append(constants[opcode])
+    return [results[-1] for results in converted]
+
+def _convert(formula: Formula, conversion: _Conversion) -> Formula:
+    return _convert_all(formula, [conversion])[0]
+
+def _memoized_conversion(converter: Callable[[Formula], Formula]) -> \
+        Callable[[Formula], Formula]:
+    # Remembers the conversion of each formula (by identity, so that no
+    # structural hashing of possibly deep formulas is needed) for as long as
+    # that formula is alive, so that converting the same formula again costs a
+    # single lookup. The entry of a formula is dropped as soon as the formula
+    # is garbage collected, before its id can be reused. A formula that is its
+    # own conversion is not remembered, since its entry would then keep it
+    # alive forever, and converting it again is a linear sweep anyway.
+    conversions: Dict[int, Tuple[ref, Formula]] = {}
+    @wraps(converter)
+    def wrapper(formula: Formula) -> Formula:
+        key = id(formula)
+        entry = conversions.get(key)
+        if entry is not None and entry[0]() is formula:
+            return entry[1]
+        def forget(reference: ref) -> None:
+            if conversions.get(key, (None,))[0] is reference:
+                del conversions[key]
+        conversion = converter(formula)
+        if conversion is not formula:
+            conversions[key] = (ref(formula, forget), conversion)
+        return conversion
+    return wrapper
+
+def _conversion(constants: Mapping[str, str],
+                rewrites: Mapping[str, str]) -> _Conversion:
+    # Builds, once, the constant replacements and the compiled rewrites of a
+    # conversion from their formula strings.
+    return ({_OPCODES[constant]: Formula.parse(formula)
+             for constant, formula in constants.items()},
+            _compile_rewrites(rewrites))
+
+# In the rewrite templates below, 'p' and 'q' stand for the converted first and
+# second operands of the rewritten operator (while in the constant
+# replacements, 'p' is simply a variable).
+
+_NOT_AND_OR = _conversion(
+    {'T': '(p|~p)', 'F': '(p&~p)'},
+    {'~': '~p', '&': '(p&q)', '|': '(p|q)', '->': '(~p|q)',
+     '+': '((p&~q)|(~p&q))', '<->': '((p&q)|(~p&~q))', '-&': '~(p&q)',
+     '-|': '~(p|q)'})
+
+@_memoized_conversion
 def to_not_and_or(formula: Formula) -> Formula:
-    if is_constant(formula.root):
-        if formula.root == 'T':
-            return Formula('|', Formula('p'), Formula('~', Formula('p')))
-        else:
-            return Formula('&', Formula('p'), Formula('~', Formula('p')))
-    if is_variable(formula.root):
-        return Formula(formula.root)
-    if is_unary(formula.root):
-        return Formula('~', to_not_and_or(formula.first))
-    if is_binary(formula.root):
-        first = to_not_and_or(formula.first)
-        second = to_not_and_or(formula.second)
-        if formula.root == '&':
-            return Formula('&', first, second)
-        if formula.root == '|':
-            return Formula('|', first, second)
-        if formula.root == '->':
-            return Formula('|', Formula('~', first), second)
-        if formula.root == '+':
-            return Formula('|',
-                          Formula('&', first, Formula('~', second)),
-                          Formula('&', Formula('~', first), second))
-        if formula.root == '<->':
-            return Formula('|',
-                          Formula('&', first, second),
-                          Formula('&', Formula('~', first), Formula('~', second)))
-        if formula.root == '-&':
-            return Formula('~', Formula('&', first, second))
-        if formula.root == '-|':
-            return Formula('~', Formula('|', first, second))
+    return _convert(formula, _NOT_AND_OR)
+
+_NOT_AND = _conversion(
+    {'T': '~(p&~p)', 'F': '(p&~p)'},
+    {'~': '~p', '&': '(p&q)', '|': '~(~p&~q)', '->': '~(p&~q)',
+     '+': '(~(p&q)&~(~p&~q))', '<->': '(~(p&~q)&~(~p&q))', '-&': '~(p&q)',
+     '-|': '(~p&~q)'})
 
+@_memoized_conversion
 def to_not_and(formula: Formula) -> Formula:
-    not_and_or = to_not_and_or(formula)
-    if is_constant(not_and_or.root):
-        return not_and_or
-    if is_variable(not_and_or.root):
-        return not_and_or
-    if is_unary(not_and_or.root):
-        return Formula('~', to_not_and(not_and_or.first))
-    if not_and_or.root == '&':
-        return Formula('&', to_not_and(not_and_or.first),
-                      to_not_and(not_and_or.second))
-    if not_and_or.root == '|':
-        return Formula('~',
-                      Formula('&',
-                             Formula('~', to_not_and(not_and_or.first)),
-                             Formula('~', to_not_and(not_and_or.second))))
+    return _convert(formula, _NOT_AND)
+
+_NAND = _conversion(
+    {'T': '(p-&(p-&p))', 'F': '((p-&(p-&p))-&(p-&(p-&p)))'},
+    {'~': '(p-&p)', '&': '((p-&q)-&(p-&q))', '|': '((p-&p)-&(q-&q))',
+     '->': '(p-&(q-&q))', '+': '((p-&(p-&q))-&(q-&(p-&q)))',
+     '<->': '((p-&q)-&((p-&p)-&(q-&q)))', '-&': '(p-&q)',
+     '-|': '(((p-&p)-&(q-&q))-&((p-&p)-&(q-&q)))'})
 
+@_memoized_conversion
 def to_nand(formula: Formula) -> Formula:
-    not_and = to_not_and(formula)
-    if is_variable(not_and.root):
-        return not_and
-    if is_unary(not_and.root):
-        arg = to_nand(not_and.first)
-        return Formula('-&', arg, arg)
-    if not_and.root == '&':
-        left = to_nand(not_and.first)
-        right = to_nand(not_and.second)
-        nand = Formula('-&', left, right)
-        return Formula('-&', nand, nand)
+    return _convert(formula, _NAND)
 
+_IMPLIES_NOT = _conversion(
+    {'T': '(p->p)', 'F': '~(p->p)'},
+    {'~': '~p', '->': '(p->q)', '&': '~(p->~q)', '|': '(~p->q)',
+     '+': '((p->q)->~(q->p))', '<->': '~((p->q)->~(q->p))', '-&': '(p->~q)',
+     '-|': '~(~p->q)'})
+
+@_memoized_conversion
 def to_implies_not(formula: Formula) -> Formula:
-    if is_variable(formula.root):
-        return formula
-    if is_constant(formula.root):
-        if formula.root == 'T':
-            return Formula('->', Formula('p'), Formula('p'))
-        else:
-            return Formula('~', Formula('->', Formula('p'), Formula('p')))
-    if is_unary(formula.root):
-        return Formula('~', to_implies_not(formula.first))
-    left = to_implies_not(formula.first)
-    right = to_implies_not(formula.second)
-    if formula.root == '->':
-        return Formula('->', left, right)
-    if formula.root == '&':
-        return Formula('~', Formula('->', left, Formula('~', right)))
-    if formula.root == '|':
-        return Formula('->', Formula('~', left), right)
-    if formula.root == '+':
-        return Formula('->', Formula('->', left, right), Formula('~', Formula('->', right, left)))
-    if formula.root == '<->':
-        return Formula('~', Formula('->', Formula('->', left, right), Formula('~', Formula('->', right, left))))
-    if formula.root == '-&':
-        return Formula('->', left, Formula('~', right))
-    if formula.root == '-|':
-        return Formula('~', Formula('->', Formula('~', left), right))
+    return _convert(formula, _IMPLIES_NOT)
+
+_IMPLIES_FALSE = _conversion(
+    {'T': '(F->F)', 'F': 'F'},
+    {'~': '(p->F)', '->': '(p->q)', '&': '((p->(q->F))->F)',
+     '|': '((p->F)->q)', '+': '((p->q)->((q->p)->F))',
+     '<->': '(((p->q)->((q->p)->F))->F)', '-&': '(p->(q->F))',
+     '-|': '(((p->F)->q)->F)'})
 
+@_memoized_conversion
 def to_implies_false(formula: Formula) -> Formula:
-    imp_not = to_implies_not(formula)
-    def convert(f):
-        if is_variable(f.root):
-            return f
-        if f.root == 'F':
-            return f
-        if f.root == '~':
-            return Formula('->', convert(f.first), Formula('F'))
-        if f.root == '->':
-            return Formula('->', convert(f.first), convert(f.second))
-        return f
-    return convert(imp_not)
\ No newline at end of file
+    return _convert(formula, _IMPLIES_FALSE)
+
+class ConvertedForms(NamedTuple):
+    """The conversions of a single formula to each of the operator sets handled
+    by this module."""
+    not_and_or: Formula
+    not_and: Formula
+    nand: Formula
+    implies_not: Formula
+    implies_false: Formula
+
+def to_all_forms(formula: Formula) -> ConvertedForms:
+    """Converts the given formula to each of the operator sets handled by this
+    module, traversing it only once.
+
+    Parameters:
+        formula: formula to convert.
+
+    Returns:
+        The results of `to_not_and_or`, `to_not_and`, `to_nand`,
+        `to_implies_not`, and `to_implies_false` on the given formula.
+    """
+    return ConvertedForms(*_convert_all(formula, [
+        _NOT_AND_OR, _NOT_AND, _NAND, _IMPLIES_NOT, _IMPLIES_FALSE]))
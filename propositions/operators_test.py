@@ -6,6 +6,8 @@
 
 """Tests for the propositions.operators module."""
 
+import sys
+
 from propositions.syntax import *
 from propositions.semantics import *
 from propositions.operators import *
@@ -85,6 +87,126 @@ def test_to_implies_false(debug=False):
                str(ff) + ' contains wrong operators'
         assert is_tautology(Formula('<->', f, ff))
 
+def test_to_all_forms(debug=False):
+    if debug:
+        print()
+    for f in many_fs:
+        if debug:
+            print('Testing conversion of', f, 'to all operator sets at once.')
+        f = Formula.parse(f)
+        forms = to_all_forms(f)
+        assert forms.not_and_or == to_not_and_or(f)
+        assert forms.not_and == to_not_and(f)
+        assert forms.nand == to_nand(f)
+        assert forms.implies_not == to_implies_not(f)
+        assert forms.implies_false == to_implies_false(f)
+
+def test_to_nand_sharing(debug=False):
+    if debug:
+        print("Testing that conversions to '-&' build repeated operands once.")
+    ff = to_nand(Formula.parse('(x&y)'))
+    assert str(ff) == '((x-&y)-&(x-&y))'
+    assert ff.first is ff.second
+    ff = to_nand(Formula.parse('~(x|~y)'))
+    assert ff.first is ff.second
+    ff = to_nand(Formula.parse('(x+y)'))
+    assert str(ff) == '((x-&(x-&y))-&(y-&(x-&y)))'
+    assert ff.first.second is ff.second.second
+
+def test_to_implies_xor_iff_sharing(debug=False):
+    if debug:
+        print("Testing that conversions of '+' and '<->' to '->' share nodes.")
+    x, y = Formula('x'), Formula('y')
+    xor = Formula('+', x, y)
+    iff = Formula('<->', x, y)
+    assert to_implies_not(iff).first is to_implies_not(xor)
+    assert to_implies_false(iff).first is to_implies_false(xor)
+
+def test_double_negations_simplified(debug=False):
+    if debug:
+        print('Testing that conversions simplify away double negations.')
+    f = Formula.parse('~~(x|~~y)')
+    assert str(to_not_and_or(f)) == '(x|y)'
+    assert str(to_not_and(f)) == '~(~x&~y)'
+    assert str(to_implies_not(f)) == '(~x->y)'
+    assert str(to_implies_false(f)) == '((x->F)->y)'
+    assert str(to_nand(Formula.parse('~~x'))) == 'x'
+
+def test_conversions_of_shared_subformulas(debug=False):
+    if debug:
+        print('Testing conversion of a formula with 2**100 leaves that are',
+              'shared by 100 nested biconditionals.')
+    f = Formula('x')
+    for _ in range(100):
+        f = Formula('<->', f, f)
+    assert to_not_and_or(f).operators().issubset({'&', '|', '~'})
+    assert to_not_and(f).operators().issubset({'&', '~'})
+    assert to_nand(f).operators().issubset({'-&'})
+    assert to_implies_not(f).operators().issubset({'->', '~'})
+    assert to_implies_false(f).operators().issubset({'->', 'F'})
+
+def test_to_implies_false_deep(debug=False):
+    depth = 10 * sys.getrecursionlimit()
+    if debug:
+        print('Testing conversion of a chain of', depth,
+              "implications to a formula using only '->' and 'F'.")
+    f = Formula('p')
+    for _ in range(depth):
+        f = Formula('->', Formula('~', Formula('q')), f)
+    ff = to_implies_false(f)
+    for _ in range(depth):
+        assert ff.root == '->' and str(ff.first) == '(q->F)'
+        ff = ff.second
+    assert str(ff) == 'p'
+
+def test_to_implies_not_deep(debug=False):
+    depth = 10 * sys.getrecursionlimit()
+    if debug:
+        print('Testing conversion of a chain of', depth,
+              "disjunctions to a formula using only '->' and '~'.")
+    f = Formula('p')
+    for _ in range(depth):
+        f = Formula('|', Formula('q'), Formula('&', f, Formula('r')))
+    ff = to_implies_not(f)
+    for _ in range(depth):
+        assert ff.root == '->' and str(ff.first) == '~q'
+        assert ff.second.root == '~' and ff.second.first.root == '->'
+        assert str(ff.second.first.second) == '~r'
+        ff = ff.second.first.first
+    assert str(ff) == 'p'
+
+def test_converted_forms_kept(debug=False):
+    for converter, infix in [(to_implies_not, '((p->~q)->~(~r->(p->s)))'),
+                             (to_implies_false, '((p->(q->F))->(r->F))'),
+                             (to_not_and_or, '(~(p&q)|~(r|~s))'),
+                             (to_nand, '((p-&q)-&(r-&(s-&s)))')]:
+        f = Formula.parse(infix)
+        if debug:
+            print('Testing that', converter.__qualname__,
+                  'keeps the formula', f)
+        assert converter(f) is f
+    f = Formula.parse('((p->~q)->(p&q))')
+    ff = to_implies_not(f)
+    assert str(ff) == '((p->~q)->~(p->~q))'
+    assert ff.first is f.first
+
+def test_converted_formulas_collected(debug=False):
+    import gc
+    from weakref import ref
+    for converter, infix in [(to_implies_not, '((p1->~q1)->~(r1->p1))'),
+                             (to_not_and_or, '((p2&q2)|r2)'),
+                             (to_nand, '((p3-|q3)-&r3)'),
+                             (to_implies_false, '((p4&q4)->F)')]:
+        if debug:
+            print('Testing that', infix, 'is collected after',
+                  converter.__qualname__)
+        f = Formula.parse(infix)
+        converter(f)
+        reference = ref(f)
+        del f
+        gc.collect()
+        assert reference() is None
+
 def test_ex3(debug=False):
     assert is_binary('+'), 'Change is_binary() before testing Chapter 3 tasks.'
     test_operators_defined(debug)
@@ -96,3 +218,12 @@ def test_ex3(debug=False):
 
 def test_all(debug=False):
     test_ex3(debug)
+    test_to_all_forms(debug)
+    test_to_nand_sharing(debug)
+    test_to_implies_xor_iff_sharing(debug)
+    test_double_negations_simplified(debug)
+    test_conversions_of_shared_subformulas(debug)
+    test_to_implies_false_deep(debug)
+    test_converted_forms_kept(debug)
+    test_to_implies_not_deep(debug)
+    test_converted_formulas_collected(debug)
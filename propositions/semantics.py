@@ -6,11 +6,16 @@
 
 """Semantic analysis of propositional-logic constructs."""
 
-from typing import AbstractSet, Iterable, Mapping, Sequence, Tuple
+from __future__ import annotations
+from typing import AbstractSet, Callable, Iterable, Iterator, List, Mapping, \
+    Optional, Sequence, Tuple
 
 from propositions.syntax import *
+from propositions.syntax import _postorder
 from propositions.proofs import *
 from itertools import product
+import sys
+from weakref import WeakKeyDictionary
 
 Model = Mapping[str, bool]
 
@@ -27,30 +32,41 @@ def variables(model: Model) -> AbstractSet[str]:
 def evaluate(formula: Formula, model: Model) -> bool:
     assert is_model(model)
     assert formula.variables().issubset(variables(model))
+    return _evaluate(formula, model)
+
+#: For each binary operator, the value of a formula with that operator at its
+#: root, given the value of its first operand, its second operand, and the
+#: model. The second operand is evaluated only if the value of the first does
+#: not already determine the value of the formula.
+_BINARY_EVALUATORS: Mapping[str, Callable[[bool, Formula, Model], bool]] = {
+    '&': lambda first_value, second, model:
+        first_value and _evaluate(second, model),
+    '|': lambda first_value, second, model:
+        first_value or _evaluate(second, model),
+    '->': lambda first_value, second, model:
+        (not first_value) or _evaluate(second, model),
+    '-&': lambda first_value, second, model:
+        not (first_value and _evaluate(second, model)),
+    '-|': lambda first_value, second, model:
+        not (first_value or _evaluate(second, model)),
+    '+': lambda first_value, second, model:
+        first_value != _evaluate(second, model),
+    '<->': lambda first_value, second, model:
+        first_value == _evaluate(second, model)}
+
+def _evaluate(formula: Formula, model: Model) -> bool:
+    # Evaluates as evaluate does, but without checking the given model again
+    # for every subformula.
     if is_constant(formula.root):
         return formula.root == 'T'
     if is_variable(formula.root):
         return model[formula.root]
     if is_unary(formula.root):
-        return not evaluate(formula.first, model)
-    assert is_binary(formula.root)
-    first_value = evaluate(formula.first, model)
-    second_value = evaluate(formula.second, model)
-    if formula.root == '&':
-        return first_value and second_value
-    if formula.root == '|':
-        return first_value or second_value
-    if formula.root == '->':
-        return (not first_value) or second_value
-    if formula.root == '+':
-        return first_value != second_value
-    if formula.root == '<->':
-        return first_value == second_value
-    if formula.root == '-&':
-        return not (first_value and second_value)
-    if formula.root == '-|':
-        return not (first_value or second_value)
-    raise ValueError('Unknown operator: ' + formula.root)
+        return not _evaluate(formula.first, model)
+    evaluator = _BINARY_EVALUATORS.get(formula.root)
+    if evaluator is None:
+        raise ValueError('Unknown operator: ' + formula.root)
+    return evaluator(_evaluate(formula.first, model), formula.second, model)
 
 def all_models(variables: Sequence[str]) -> Iterable[Model]:
     for v in variables:
@@ -58,6 +74,26 @@ def all_models(variables: Sequence[str]) -> Iterable[Model]:
     for values in product([False, True], repeat=len(variables)):
         yield dict(zip(variables, values))
 
+def _all_models_mut(variables: Sequence[str]) -> Iterable[Model]:
+    # Generates the same models as all_models, in the same order, but as a
+    # single dictionary that is updated in place from each model to the next,
+    # so it must not be retained by the caller. The values are advanced as a
+    # binary counter, so each step updates a constant number of entries on
+    # average.
+    for v in variables:
+        assert is_variable(v)
+    model = dict.fromkeys(variables, False)
+    yield model
+    while True:
+        index = len(variables) - 1
+        while index >= 0 and model[variables[index]]:
+            model[variables[index]] = False
+            index -= 1
+        if index < 0:
+            return
+        model[variables[index]] = True
+        yield model
+
 def truth_values(formula: Formula, models: Iterable[Model]) -> Iterable[bool]:
     for model in models:
         yield evaluate(formula, model)
@@ -65,90 +101,216 @@ def truth_values(formula: Formula, models: Iterable[Model]) -> Iterable[bool]:
 def print_truth_table(formula: Formula) -> None:
     variables_sorted = sorted(formula.variables())
     headers = list(variables_sorted) + [str(formula)]
-    widths = [len(header) for header in headers]
-    for i in range(len(widths)):
-        if widths[i] < 1:
-            widths[i] = 1
-
-    def format_row(values: Sequence[str]) -> str:
-        return '|' + '|'.join(' ' + value.ljust(width) + ' '
-                              for value, width in zip(values, widths)) + '|'
-
-    print(format_row(headers))
-    print('|' + '|'.join('-' * (width + 2) for width in widths) + '|')
-    for model in all_models(variables_sorted):
-        values = [('T' if model[var] else 'F') for var in variables_sorted]
-        values.append('T' if evaluate(formula, model) else 'F')
-        print(format_row(values))
+    widths = [max(len(header), 1) for header in headers]
+    # Every row, the header included, is laid out by the same template.
+    row_template = \
+        '|' + '|'.join(' {:<' + str(width) + '} ' for width in widths) + '|\n'
+    lines = [row_template.format(*headers),
+             '|' + '|'.join('-' * (width + 2) for width in widths) + '|\n']
+    # The value of the formula in the i-th model is the i-th bit of its truth
+    # values over all blocks of models in turn, as both follow the order of
+    # all_models, so each block is spelled out as binary digits, lowest first.
+    bits = ''.join(format(values, '0' + str(all_set.bit_length()) + 'b')[::-1]
+                   for values, all_set in _truth_table_blocks(formula))
+    for model, bit in zip(_all_models_mut(variables_sorted), bits):
+        lines.append(row_template.format(
+            *[('T' if model[var] else 'F') for var in variables_sorted],
+            'T' if bit == '1' else 'F'))
+    # The whole table is written at once. The standard output is looked up
+    # only now, so that it can be redirected by replacing sys.stdout.
+    sys.stdout.write(''.join(lines))
+
+def _variable_column(index: int, number_of_variables: int) -> int:
+    # The truth values of the variable at the given index over all models over
+    # the given number of variables, as a bit mask whose i-th bit is the value
+    # in the i-th model generated by all_models: runs of 2**k zeros alternating
+    # with runs of 2**k ones, where k is the number of variables after it. The
+    # mask is built from a single period by doubling, in linear time.
+    run = 1 << (number_of_variables - 1 - index)
+    column = ((1 << run) - 1) << run
+    width = 2 * run
+    while width < 1 << number_of_variables:
+        column |= column << width
+        width *= 2
+    return column
+
+#: For each binary operator, the truth values of a formula with that operator
+#: at its root over a set of models, given as bit masks the truth values of its
+#: first and second operands over these models and the mask whose bits for all
+#: these models are set.
+_BINARY_COLUMN_OPERATIONS: Mapping[str, Callable[[int, int, int], int]] = {
+    '&': lambda first, second, all_set: first & second,
+    '|': lambda first, second, all_set: first | second,
+    '->': lambda first, second, all_set: (first ^ all_set) | second,
+    '+': lambda first, second, all_set: first ^ second,
+    '<->': lambda first, second, all_set: first ^ second ^ all_set,
+    '-&': lambda first, second, all_set: (first & second) ^ all_set,
+    '-|': lambda first, second, all_set: (first | second) ^ all_set}
+
+#: The largest number of variables over whose models a formula is evaluated at
+#: once. Formulas with more variables are evaluated in blocks of models, so
+#: that the bit masks stay small and evaluation can stop at the first block
+#: that settles the question asked.
+_BLOCK_VARIABLES = 12
+
+#: The roots of the distinct subformulas of a formula in post-order, the
+#: positions of their operands, and for each subformula, the positions of its
+#: operands that are not used by any later subformula. Only strings and
+#: positions are kept, so that an evaluation plan does not keep its formula
+#: alive.
+_EvaluationPlan = Tuple[List[str], List[int], List[int], List[List[int]]]
+
+#: The evaluation plans computed by _evaluation_plan, for as long as their
+#: formulas are alive. Formulas are hashed by identity, so looking a formula
+#: up does not traverse it.
+_evaluation_plans: WeakKeyDictionary[Formula, _EvaluationPlan] = \
+    WeakKeyDictionary()
+
+def _evaluation_plan(formula: Formula) -> _EvaluationPlan:
+    # Returns the evaluation plan of the given formula, computing it only once
+    # per formula.
+    plan = _evaluation_plans.get(formula)
+    if plan is None:
+        nodes, _, firsts, seconds = _postorder(formula, {}, None)
+        last_uses = list(range(len(nodes)))
+        for position, (first, second) in enumerate(zip(firsts, seconds)):
+            for operand in (first, second):
+                if operand >= 0:
+                    last_uses[operand] = position
+        releases: List[List[int]] = [[] for _ in nodes]
+        for position, last_use in enumerate(last_uses):
+            if last_use != position:
+                releases[last_use].append(position)
+        plan = _evaluation_plans[formula] = \
+            ([node.root for node in nodes], firsts, seconds, releases)
+    return plan
+
+def _truth_table_blocks(formula: Formula) -> Iterator[Tuple[int, int]]:
+    # Evaluates the given formula in all models over its variables, using each
+    # bit of a Python integer as a separate model. The models are taken in
+    # consecutive blocks of at most 2**_BLOCK_VARIABLES models each, in the
+    # order of all_models over the sorted variables of the formula. Yields for
+    # each block the truth values as a bit mask whose i-th bit is the value in
+    # the i-th model of the block, along with the mask whose bits for all models
+    # of the block are set.
+    roots, firsts, seconds, releases = _evaluation_plan(formula)
+    variables_sorted = sorted(root for root in roots if is_variable(root))
+    # Within a block, only the last variables change, while each of the first
+    # ones has the value of the corresponding bit of the block's number.
+    changing = min(len(variables_sorted), _BLOCK_VARIABLES)
+    fixed = len(variables_sorted) - changing
+    all_set = (1 << (1 << changing)) - 1
+    changing_columns = {
+        variable: _variable_column(index, changing)
+        for index, variable in enumerate(variables_sorted[fixed:])}
+    for block in range(1 << fixed):
+        columns = dict(changing_columns)
+        for index, variable in enumerate(variables_sorted[:fixed]):
+            columns[variable] = \
+                all_set if (block >> (fixed - 1 - index)) & 1 else 0
+        # A single pass over the subformulas in post-order, in which the
+        # operands of each subformula are already evaluated. The values of
+        # operands that are not used again are dropped right away.
+        values: List[Optional[int]] = []
+        for root, first, second, released in \
+                zip(roots, firsts, seconds, releases):
+            if is_constant(root):
+                value = all_set if root == 'T' else 0
+            elif is_variable(root):
+                value = columns[root]
+            elif is_unary(root):
+                value = values[first] ^ all_set
+            else:
+                operation = _BINARY_COLUMN_OPERATIONS.get(root)
+                if operation is None:
+                    raise ValueError('Unknown operator: ' + root)
+                value = operation(values[first], values[second], all_set)
+            values.append(value)
+            for position in released:
+                values[position] = None
+        yield values[-1], all_set
 
 def is_tautology(formula: Formula) -> bool:
-    return all(truth_values(formula, all_models(sorted(formula.variables()))))
+    return all(values == all_set
+               for values, all_set in _truth_table_blocks(formula))
 
 def is_contradiction(formula: Formula) -> bool:
-    return not any(truth_values(formula, all_models(sorted(formula.variables()))))
+    return all(values == 0 for values, _ in _truth_table_blocks(formula))
 
 def is_satisfiable(formula: Formula) -> bool:
-    return any(truth_values(formula, all_models(sorted(formula.variables()))))
+    return any(values != 0 for values, _ in _truth_table_blocks(formula))
+
+def _fold(operator: str, formulas: List[Formula]) -> Formula:
+    # Combines the given nonempty list of formulas with the given binary
+    # operator into a balanced tree, pairing up neighbours level by level, so
+    # that the result has logarithmic rather than linear depth.
+    assert len(formulas) > 0
+    while len(formulas) > 1:
+        paired = [Formula(operator, formulas[i], formulas[i + 1])
+                  for i in range(0, len(formulas) - 1, 2)]
+        if len(formulas) % 2 == 1:
+            paired.append(formulas[-1])
+        formulas = paired
+    return formulas[0]
+
+def _literals(variables: Sequence[str]) -> \
+        Tuple[List[Formula], List[Formula]]:
+    # The positive and the negative literals of the given variables, in the
+    # same order, built once so that all clauses over these variables can share
+    # them.
+    positive = [Formula(variable) for variable in variables]
+    negative = [Formula('~', literal) for literal in positive]
+    return positive, negative
 
 def _synthesize_for_model(model: Model) -> Formula:
     assert is_model(model)
     assert len(model.keys()) > 0
-    literals = []
-    for variable in sorted(model.keys()):
-        if model[variable]:
-            literals.append(Formula(variable))
-        else:
-            literals.append(Formula('~', Formula(variable)))
-    formula = literals[0]
-    for literal in literals[1:]:
-        formula = Formula('&', formula, literal)
-    return formula
+    variables = sorted(model.keys())
+    positive, negative = _literals(variables)
+    return _fold('&', [positive[i] if model[variable] else negative[i]
+                       for i, variable in enumerate(variables)])
 
 def synthesize(variables: Sequence[str], values: Iterable[bool]) -> Formula:
     assert len(variables) > 0
-    models = list(all_models(variables))
+    for variable in variables:
+        assert is_variable(variable)
+    positive, negative = _literals(variables)
+    # The literals of each clause are ordered by their variables' names.
+    order = sorted(range(len(variables)), key=variables.__getitem__)
     clauses = []
-    for model, value in zip(models, values):
+    for model_values, value in zip(product((False, True),
+                                           repeat=len(variables)), values):
         if value:
-            clauses.append(_synthesize_for_model(model))
+            clauses.append(_fold('&', [positive[i] if model_values[i]
+                                       else negative[i] for i in order]))
     if not clauses:
-        first_var = variables[0]
-        return Formula('&', Formula(first_var),
-                       Formula('~', Formula(first_var)))
-    formula = clauses[0]
-    for clause in clauses[1:]:
-        formula = Formula('|', formula, clause)
-    return formula
+        return Formula('&', positive[0], negative[0])
+    return _fold('|', clauses)
 
 def _synthesize_for_all_except_model(model: Model) -> Formula:
     assert is_model(model)
     assert len(model.keys()) > 0
-    literals = []
-    for variable in sorted(model.keys()):
-        if model[variable]:
-            literals.append(Formula('~', Formula(variable)))
-        else:
-            literals.append(Formula(variable))
-    formula = literals[0]
-    for literal in literals[1:]:
-        formula = Formula('|', formula, literal)
-    return formula
+    variables = sorted(model.keys())
+    positive, negative = _literals(variables)
+    return _fold('|', [negative[i] if model[variable] else positive[i]
+                       for i, variable in enumerate(variables)])
 
 def synthesize_cnf(variables: Sequence[str], values: Iterable[bool]) -> Formula:
     assert len(variables) > 0
-    models = list(all_models(variables))
+    for variable in variables:
+        assert is_variable(variable)
+    positive, negative = _literals(variables)
+    # The literals of each clause are ordered by their variables' names.
+    order = sorted(range(len(variables)), key=variables.__getitem__)
     clauses = []
-    for model, value in zip(models, values):
+    for model_values, value in zip(product((False, True),
+                                           repeat=len(variables)), values):
         if not value:
-            clauses.append(_synthesize_for_all_except_model(model))
+            clauses.append(_fold('|', [negative[i] if model_values[i]
+                                       else positive[i] for i in order]))
     if not clauses:
-        first_var = variables[0]
-        return Formula('|', Formula(first_var),
-                       Formula('~', Formula(first_var)))
-    formula = clauses[0]
-    for clause in clauses[1:]:
-        formula = Formula('&', formula, clause)
-    return formula
+        return Formula('|', positive[0], negative[0])
+    return _fold('&', clauses)
 
 def evaluate_inference(rule: InferenceRule, model: Model) -> bool:
     assert is_model(model)
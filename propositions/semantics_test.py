@@ -72,6 +72,14 @@ def test_all_models(debug=False):
             print('Testing all models over', variables)
         assert list(all_models(tuple(variables))) == models
 
+def test_all_models_mut(debug=False):
+    from propositions.semantics import _all_models_mut
+    for variables in [(), ('x',), ('p', 'q'), ('q', 'p', 'r12', 's')]:
+        if debug:
+            print('Testing in-place models over', variables)
+        models = [dict(model) for model in _all_models_mut(variables)]
+        assert models == list(all_models(variables))
+
 def test_truth_values(debug=False):
     for infix,variables,values in [
             ['~(p&q7)', ('p', 'q7'), [True, True, True, False]],
@@ -412,6 +420,74 @@ def test_is_sound_inference(debug=False):
             print('Testing that', rule, 'is sound')
         assert is_sound_inference(rule)
 
+def test_synthesize_balanced(debug=False):
+    def depth(formula):
+        if is_variable(formula.root) or is_constant(formula.root):
+            return 0
+        if is_unary(formula.root):
+            return 1 + depth(formula.first)
+        return 1 + max(depth(formula.first), depth(formula.second))
+    variables = tuple('p' + str(i) for i in range(10))
+    for synthesizer, value in [(synthesize, True), (synthesize_cnf, False)]:
+        if debug:
+            print('Testing the depth of', synthesizer.__qualname__,
+                  'over', len(variables), 'variables')
+        formula = synthesizer(variables, [value] * 2**len(variables))
+        # 10 levels of clauses over 4 levels of literals and a negation.
+        assert depth(formula) <= 15, \
+               'Depth ' + str(depth(formula)) + ' is not logarithmic'
+
+def test_is_tautology_deep(debug=False):
+    import sys
+    depth = 10 * sys.getrecursionlimit()
+    if debug:
+        print('Testing tautology checks of formulas nested', depth,
+              'levels deep')
+    formula = Formula('p')
+    for _ in range(depth):
+        formula = Formula('~', Formula('~', formula))
+    formula = Formula('|', formula, Formula('~', Formula('p')))
+    assert is_tautology(formula)
+    assert not is_contradiction(formula)
+    assert is_satisfiable(formula)
+
+def test_evaluation_plan_reused(debug=False):
+    from propositions.semantics import _evaluation_plan
+    import gc
+    from weakref import ref
+    formula = Formula.parse('((p->q)|(q->p))')
+    if debug:
+        print('Testing that the evaluation plan of', formula, 'is reused')
+    assert is_tautology(formula)
+    plan = _evaluation_plan(formula)
+    assert is_satisfiable(formula) and not is_contradiction(formula)
+    assert _evaluation_plan(formula) is plan
+    reference = ref(formula)
+    del formula
+    gc.collect()
+    assert reference() is None
+
+def test_many_variables(debug=False):
+    variables = ['p' + str(i) for i in range(1, 41)]
+    if debug:
+        print('Testing formulas over', len(variables), 'variables')
+    disjunction = Formula(variables[0])
+    conjunction = Formula(variables[0])
+    for variable in variables[1:]:
+        disjunction = Formula('|', disjunction,
+                              Formula('~', Formula(variable)))
+        conjunction = Formula('&', conjunction, Formula(variable))
+    assert is_satisfiable(disjunction)
+    assert not is_contradiction(disjunction)
+    assert not is_tautology(conjunction)
+    # Deciding these requires going over all models.
+    conjunction = Formula(variables[0])
+    for variable in variables[1:16]:
+        conjunction = Formula('&', conjunction, Formula(variable))
+    assert is_tautology(Formula('->', conjunction, Formula(variables[15])))
+    assert not is_tautology(Formula('->', Formula(variables[15]), conjunction))
+    assert not is_contradiction(conjunction)
+
 def test_ex2(debug=False):
     test_evaluate(debug)
     test_all_models(debug)
@@ -440,4 +516,9 @@ def test_all(debug=False):
     test_ex2(debug)
     test_ex2_opt(debug)
     test_ex3(debug)
+    test_all_models_mut(debug)
+    test_synthesize_balanced(debug)
+    test_is_tautology_deep(debug)
+    test_evaluation_plan_reused(debug)
+    test_many_variables(debug)
     test_ex4(debug)
@@ -7,136 +7,289 @@
 """Syntactic handling of propositional formulas."""
 
 from __future__ import annotations
-from functools import lru_cache
-from typing import Mapping, Optional, Set, Tuple, Union
+from typing import Dict, FrozenSet, List, Mapping, Optional, Tuple, TypeVar, \
+    Union
+from weakref import WeakValueDictionary
 
-from logic_utils import frozen, memoized_parameterless_method
+_T = TypeVar('_T')
 
-@lru_cache(maxsize=100)
 def is_variable(string: str) -> bool:
     return string[0] >= 'p' and string[0] <= 'z' and \
            (len(string) == 1 or string[1:].isdecimal())
 
-@lru_cache(maxsize=100)
 def is_constant(string: str) -> bool:
     return string == 'T' or string == 'F'
 
-@lru_cache(maxsize=100)
 def is_unary(string: str) -> bool:
     return string == '~'
 
-@lru_cache(maxsize=100)
 def is_binary(string: str) -> bool:
-    return string in {'&', '|', '->', '+', '<->', '-&', '-|'}
+    return string in _BINARY_OPERATORS
+
+#: The binary operators, ordered so that no operator comes after another
+#: operator that is a prefix of it.
+_BINARY_OPERATORS_LONGEST_FIRST = ('<->', '-&', '-|', '->', '&', '|', '+')
+
+_BINARY_OPERATORS = frozenset(_BINARY_OPERATORS_LONGEST_FIRST)
+
+#: Classes of the characters that can start a formula, so that the parsers
+#: can classify the next character by a single dictionary lookup.
+_CONSTANT_CHARACTER, _VARIABLE_START_CHARACTER, _UNARY_CHARACTER, \
+    _OPENING_PARENTHESIS_CHARACTER = range(4)
+
+_CHARACTER_CLASSES: Mapping[str, int] = {
+    'T': _CONSTANT_CHARACTER, 'F': _CONSTANT_CHARACTER,
+    '~': _UNARY_CHARACTER, '(': _OPENING_PARENTHESIS_CHARACTER,
+    **{character: _VARIABLE_START_CHARACTER
+       for character in 'pqrstuvwxyz'}}
+
+def _union(first: FrozenSet[str], second: FrozenSet[str]) -> FrozenSet[str]:
+    # Returns one of the given sets itself, rather than a new set, whenever it
+    # already contains the other.
+    if second <= first:
+        return first
+    if first <= second:
+        return second
+    return first | second
+
+#: The number of operands of each operator.
+_ARITIES: Mapping[str, int] = {'~': 1, **dict.fromkeys(_BINARY_OPERATORS, 2)}
+
+def _postorder(formula: Formula, codes: Mapping[str, _T], default: _T) -> \
+        Tuple[List[Formula], List[_T], List[int], List[int]]:
+    # Lists the distinct (by identity) subformulas of the given formula in
+    # post-order, so that the operands of each subformula precede it, along
+    # with the code of the root of each subformula in the given codes (or the
+    # given default for roots that have no code there), and the positions in
+    # that list of the first and second operands of each subformula (or -1 for
+    # operands that it does not have). The formula is walked with an explicit
+    # stack, so that deeply nested formulas do not exhaust the call stack, and
+    # the root of each subformula is classified only once. All listed
+    # subformulas are kept alive by the given formula, so their ids cannot be
+    # reused while the walk is going on.
+    nodes: List[Formula] = []
+    root_codes: List[_T] = []
+    firsts: List[int] = []
+    seconds: List[int] = []
+    index: Dict[int, int] = {}
+    arity_of = _ARITIES.get
+    code_of = codes.get
+    stack: List[Tuple[Formula, int, bool]] = \
+        [(formula, arity_of(formula.root, 0), False)]
+    push, pop = stack.append, stack.pop
+    while len(stack) > 0:
+        node, arity, operands_listed = pop()
+        if id(node) in index:
+            continue
+        if arity == 0:
+            first = second = -1
+        elif not operands_listed:
+            push((node, arity, True))
+            if arity == 2:
+                operand = node.second
+                push((operand, arity_of(operand.root, 0), False))
+            operand = node.first
+            push((operand, arity_of(operand.root, 0), False))
+            continue
+        else:
+            first = index[id(node.first)]
+            second = index[id(node.second)] if arity == 2 else -1
+        index[id(node)] = len(nodes)
+        nodes.append(node)
+        root_codes.append(code_of(node.root, default))
+        firsts.append(first)
+        seconds.append(second)
+    return nodes, root_codes, firsts, seconds
+
+#: All live formulas, keyed by their root and the identities of their operands.
+#: An entry keeps its operands alive, so their ids cannot be reused while it
+#: exists.
+_interned: WeakValueDictionary[Tuple[str, int, int], Formula] = \
+    WeakValueDictionary()
 
-@frozen
 class Formula:
+    # The fields are slots, for compact nodes and fast field access, including
+    # a slot for the memoized value of each of __repr__, variables and
+    # operators. Weak references to formulas are supported. Formulas are
+    # immutable: __setattr__ and __delattr__ always raise, and the slots are
+    # only ever filled through object.__setattr__.
+    __slots__ = ('root', 'first', 'second', '_repr', '_variables',
+                 '_operators', '__weakref__')
+
     root: str
     first: Optional[Formula]
     second: Optional[Formula]
 
+    def __new__(cls, root: str, first: Optional[Formula] = None,
+                second: Optional[Formula] = None) -> Formula:
+        # Formulas are interned: constructing a formula with the same root and
+        # the same operand objects as a live formula returns that formula, so
+        # that structurally equal formulas share their subformulas rather than
+        # duplicate them.
+        key = (root, id(first), id(second))
+        formula = _interned.get(key)
+        if formula is None:
+            formula = super().__new__(cls)
+            _interned[key] = formula
+        return formula
+
     def __init__(self, root: str, first: Optional[Formula] = None,
                  second: Optional[Formula] = None):
+        if hasattr(self, 'root'):
+            # An interned formula that was already initialized.
+            return
         if is_variable(root) or is_constant(root):
             assert first is None and second is None
-            self.root = root
         elif is_unary(root):
             assert first is not None and second is None
-            self.root, self.first = root, first
+            object.__setattr__(self, 'first', first)
         else:
             assert is_binary(root)
             assert first is not None and second is not None
-            self.root, self.first, self.second = root, first, second
+            object.__setattr__(self, 'first', first)
+            object.__setattr__(self, 'second', second)
+        object.__setattr__(self, '_repr', None)
+        object.__setattr__(self, '_variables', None)
+        object.__setattr__(self, '_operators', None)
+        # Set last, since it marks the formula as initialized.
+        object.__setattr__(self, 'root', root)
+
+    def __setattr__(self, name: str, value: object) -> None:
+        raise Exception("Cannot assign to field '" + name +
+                        "' of immutable class 'Formula'")
+
+    def __delattr__(self, name: str) -> None:
+        raise Exception("Cannot delete field '" + name +
+                        "' of immutable class 'Formula'")
+
+    def __reduce__(self) -> Tuple[type, Tuple[object, ...]]:
+        # Formulas are pickled as the arguments to construct them, so that
+        # unpickling goes through interning like any other construction.
+        if is_variable(self.root) or is_constant(self.root):
+            return Formula, (self.root,)
+        if is_unary(self.root):
+            return Formula, (self.root, self.first)
+        return Formula, (self.root, self.first, self.second)
+
+    def __copy__(self) -> Formula:
+        # Formulas are immutable and interned, so a copy would have to be this
+        # very formula for equality (which is identity) to hold.
+        return self
+
+    def __deepcopy__(self, memo: Mapping[int, object]) -> Formula:
+        return self
 
-    @memoized_parameterless_method
     def __repr__(self) -> str:
+        if self._repr is None:
+            object.__setattr__(self, '_repr', self._compute_repr())
+        return self._repr
+
+    def _compute_repr(self) -> str:
         if is_variable(self.root) or is_constant(self.root):
             return self.root
         if is_unary(self.root):
-            return self.root + str(self.first)
+            return f'{self.root}{self.first!s}'
         assert is_binary(self.root)
-        return '(' + str(self.first) + self.root + str(self.second) + ')'
+        return f'({self.first!s}{self.root}{self.second!s})'
 
     def __eq__(self, other: object) -> bool:
-        return isinstance(other, Formula) and str(self) == str(other)
+        # Formulas are interned, so structurally equal formulas are the very
+        # same object, and neither comparing nor hashing needs to traverse them.
+        return self is other
 
     def __ne__(self, other: object) -> bool:
         return not self == other
 
     def __hash__(self) -> int:
-        return hash(str(self))
+        return object.__hash__(self)
+
+    def variables(self) -> FrozenSet[str]:
+        if self._variables is None:
+            object.__setattr__(self, '_variables', self._compute_variables())
+        return self._variables
 
-    @memoized_parameterless_method
-    def variables(self) -> Set[str]:
+    def _compute_variables(self) -> FrozenSet[str]:
         if is_variable(self.root):
-            return {self.root}
+            return frozenset({self.root})
         if is_constant(self.root):
-            return set()
+            return frozenset()
         if is_unary(self.root):
             return self.first.variables()
         assert is_binary(self.root)
-        return self.first.variables().union(self.second.variables())
+        return _union(self.first.variables(), self.second.variables())
 
-    @memoized_parameterless_method
-    def operators(self) -> Set[str]:
+    def operators(self) -> FrozenSet[str]:
+        if self._operators is None:
+            object.__setattr__(self, '_operators', self._compute_operators())
+        return self._operators
+
+    def _compute_operators(self) -> FrozenSet[str]:
         if is_variable(self.root):
-            return set()
+            return frozenset()
         if is_constant(self.root):
-            return {self.root}
+            return frozenset({self.root})
+        operators = self.first.operators()
+        if self.root not in operators:
+            operators = operators.union({self.root})
         if is_unary(self.root):
-            return {self.root}.union(self.first.operators())
+            return operators
         assert is_binary(self.root)
-        return {self.root}.union(self.first.operators(),
-                                 self.second.operators())
+        return _union(operators, self.second.operators())
         
     @staticmethod
     def _parse_prefix(string: str) -> Tuple[Union[Formula, None], str]:
-        if len(string) == 0:
-            return None, 'Unexpected end of input'
-
-        if is_constant(string[0]):
-            return Formula(string[0]), string[1:]
-
-        if string[0] >= 'p' and string[0] <= 'z':
-            index = 1
-            while index < len(string) and string[index].isdecimal():
-                index += 1
-            variable = string[:index]
-            if is_variable(variable):
-                return Formula(variable), string[index:]
-
-        if is_unary(string[0]):
-            formula, remainder = Formula._parse_prefix(string[1:])
-            if formula is None:
-                return None, remainder
-            return Formula(string[0], formula), remainder
-
-        if string[0] == '(':
-            first, remainder = Formula._parse_prefix(string[1:])
-            if first is None:
-                return None, remainder
-            if remainder == '':
-                return None, 'Expected binary operator'
-
-            operator = None
-            max_op_length = min(3, len(remainder))
-            for length in range(max_op_length, 0, -1):
-                candidate = remainder[:length]
-                if is_binary(candidate):
-                    operator = candidate
-                    remainder = remainder[length:]
-                    break
-            if operator is None:
-                return None, 'Expected binary operator'
-
-            second, remainder = Formula._parse_prefix(remainder)
-            if second is None:
-                return None, remainder
-            if remainder == '' or remainder[0] != ')':
-                return None, 'Expected closing parenthesis'
-            return Formula(operator, first, second), remainder[1:]
+        # Parses iteratively, so that deeply nested formulas do not exhaust the
+        # call stack. Each entry of the stack is an operator whose operands are
+        # still being parsed: '~', or '(' with the first operand and the
+        # binary operator (both None until the first operand is parsed).
+        stack: List[Tuple[str, Optional[Formula], Optional[str]]] = []
+        position = 0
+        while True:
+            if position == len(string):
+                return None, 'Unexpected end of input'
+            character_class = _CHARACTER_CLASSES.get(string[position])
+            if character_class == _CONSTANT_CHARACTER:
+                formula = Formula(string[position])
+                position += 1
+            elif character_class == _VARIABLE_START_CHARACTER:
+                start = position
+                position += 1
+                while position < len(string) and \
+                      string[position].isdecimal():
+                    position += 1
+                formula = Formula(string[start:position])
+            elif character_class == _UNARY_CHARACTER or \
+                 character_class == _OPENING_PARENTHESIS_CHARACTER:
+                stack.append((string[position], None, None))
+                position += 1
+                continue
+            else:
+                return None, 'Invalid formula'
 
-        return None, 'Invalid formula'
+            # A complete subformula was parsed, so complete as many of the
+            # pending operators as possible.
+            while len(stack) > 0:
+                kind, first, operator = stack[-1]
+                if is_unary(kind):
+                    stack.pop()
+                    formula = Formula(kind, formula)
+                elif first is None:
+                    for operator in _BINARY_OPERATORS_LONGEST_FIRST:
+                        if string.startswith(operator, position):
+                            break
+                    else:
+                        return None, 'Expected binary operator'
+                    stack[-1] = (kind, formula, operator)
+                    position += len(operator)
+                    break
+                else:
+                    stack.pop()
+                    if position == len(string) or string[position] != ')':
+                        return None, 'Expected closing parenthesis'
+                    formula = Formula(operator, first, formula)
+                    position += 1
+            else:
+                return formula, string[position:]
 
     @staticmethod
     def is_formula(string: str) -> bool:
@@ -161,43 +314,51 @@ class Formula:
     @staticmethod
     def parse_polish(string: str) -> Formula:
         def parse_prefix(s: str) -> Tuple[Union[Formula, None], str]:
-            if s == '':
-                return None, 'Unexpected end of input'
-
-            if is_constant(s[0]):
-                return Formula(s[0]), s[1:]
-
-            if s[0] >= 'p' and s[0] <= 'z':
-                index = 1
-                while index < len(s) and s[index].isdecimal():
-                    index += 1
-                name = s[:index]
-                if is_variable(name):
-                    return Formula(name), s[index:]
-
-            if is_unary(s[0]):
-                formula, remainder = parse_prefix(s[1:])
-                if formula is None:
-                    return None, remainder
-                return Formula(s[0], formula), remainder
-
-            operator = None
-            if len(s) >= 2 and is_binary(s[:2]):
-                operator = s[:2]
-                remainder = s[2:]
-            elif is_binary(s[0]):
-                operator = s[0]
-                remainder = s[1:]
-            else:
-                return None, 'Invalid formula'
-
-            first, remainder = parse_prefix(remainder)
-            if first is None:
-                return None, remainder
-            second, remainder = parse_prefix(remainder)
-            if second is None:
-                return None, remainder
-            return Formula(operator, first, second), remainder
+            # Parses iteratively, like Formula._parse_prefix. Each entry of the
+            # stack is an operator whose operands are still being parsed,
+            # along with its first operand once that is parsed.
+            stack: List[Tuple[str, Optional[Formula]]] = []
+            position = 0
+            while True:
+                if position == len(s):
+                    return None, 'Unexpected end of input'
+                character_class = _CHARACTER_CLASSES.get(s[position])
+                if character_class == _CONSTANT_CHARACTER:
+                    formula = Formula(s[position])
+                    position += 1
+                elif character_class == _VARIABLE_START_CHARACTER:
+                    start = position
+                    position += 1
+                    while position < len(s) and s[position].isdecimal():
+                        position += 1
+                    formula = Formula(s[start:position])
+                elif character_class == _UNARY_CHARACTER:
+                    stack.append((s[position], None))
+                    position += 1
+                    continue
+                else:
+                    for operator in _BINARY_OPERATORS_LONGEST_FIRST:
+                        if s.startswith(operator, position):
+                            break
+                    else:
+                        return None, 'Invalid formula'
+                    stack.append((operator, None))
+                    position += len(operator)
+                    continue
+
+                # A complete subformula was parsed, so complete as many of the
+                # pending operators as possible.
+                while len(stack) > 0:
+                    operator, first = stack.pop()
+                    if is_unary(operator):
+                        formula = Formula(operator, formula)
+                    elif first is None:
+                        stack.append((operator, formula))
+                        break
+                    else:
+                        formula = Formula(operator, first, formula)
+                else:
+                    return formula, s[position:]
 
         formula, remainder = parse_prefix(string)
         assert formula is not None and remainder == ''
@@ -206,41 +367,48 @@ class Formula:
     def substitute_variables(self, substitution_map: Mapping[str, Formula]) -> Formula:
         for variable in substitution_map:
             assert is_variable(variable)
+        return self._substitute_variables(substitution_map)
+
+    def _substitute_variables(self, substitution_map: Mapping[str, Formula]) \
+            -> Formula:
+        # Substitutes as substitute_variables does, but without checking the
+        # given map again for every subformula. A subformula none of whose
+        # variables is substituted is returned as is rather than rebuilt.
+        if self.variables().isdisjoint(substitution_map):
+            return self
         if is_variable(self.root):
-            if self.root in substitution_map:
-                return substitution_map[self.root]
-            return Formula(self.root)
-        if is_constant(self.root):
-            return Formula(self.root)
+            return substitution_map[self.root]
+        first = self.first._substitute_variables(substitution_map)
         if is_unary(self.root):
-            return Formula(self.root, self.first.substitute_variables(substitution_map))
-        if is_binary(self.root):
-            return Formula(self.root,
-                          self.first.substitute_variables(substitution_map),
-                          self.second.substitute_variables(substitution_map))
+            return Formula(self.root, first)
+        assert is_binary(self.root)
+        second = self.second._substitute_variables(substitution_map)
+        return Formula(self.root, first, second)
 
     def substitute_operators(self, substitution_map: Mapping[str, Formula]) -> Formula:
         for operator in substitution_map:
             assert is_constant(operator) or is_unary(operator) or is_binary(operator)
             assert substitution_map[operator].variables().issubset({'p', 'q'})
+        return self._substitute_operators(substitution_map)
+
+    def _substitute_operators(self, substitution_map: Mapping[str, Formula]) \
+            -> Formula:
+        # Substitutes as substitute_operators does, but without checking the
+        # given map again for every subformula. A subformula none of whose
+        # operators is substituted is returned as is rather than rebuilt.
+        if self.operators().isdisjoint(substitution_map):
+            return self
         if is_constant(self.root):
-            if self.root in substitution_map:
-                return substitution_map[self.root]
-            return Formula(self.root)
-        if is_variable(self.root):
-            return Formula(self.root)
+            return substitution_map[self.root]
+        first = self.first._substitute_operators(substitution_map)
         if is_unary(self.root):
             if self.root in substitution_map:
-                sub = substitution_map[self.root]
-                new_first = self.first.substitute_operators(substitution_map)
-                return sub.substitute_variables({'p': new_first})
-            return Formula(self.root, self.first.substitute_operators(substitution_map))
-        if is_binary(self.root):
-            if self.root in substitution_map:
-                sub = substitution_map[self.root]
-                new_first = self.first.substitute_operators(substitution_map)
-                new_second = self.second.substitute_operators(substitution_map)
-                return sub.substitute_variables({'p': new_first, 'q': new_second})
-            return Formula(self.root,
-                          self.first.substitute_operators(substitution_map),
-                          self.second.substitute_operators(substitution_map))
\ No newline at end of file
+                return substitution_map[self.root]._substitute_variables(
+                    {'p': first})
+            return Formula(self.root, first)
+        assert is_binary(self.root)
+        second = self.second._substitute_operators(substitution_map)
+        if self.root in substitution_map:
+            return substitution_map[self.root]._substitute_variables(
+                {'p': first, 'q': second})
+        return Formula(self.root, first, second)
@@ -6,6 +6,8 @@
 
 """Tests for the propositions.syntax module."""
 
+import sys
+
 from logic_utils import frozendict
 
 from propositions.syntax import *
@@ -156,6 +158,32 @@ def test_parse_polish(debug=False):
             print("Testing polish parsing of formula", polish)
         assert Formula.parse_polish(polish).polish() == polish
 
+def test_parse_polish_all_operators(debug=False):
+    for polish in ['<->x12y', '-&~x-|yT', '+->pq<->qp']:
+        if debug:
+            print("Testing polish parsing of formula", polish)
+        assert Formula.parse_polish(polish).polish() == polish
+
+def test_parse_deep(debug=False):
+    depth = 10 * sys.getrecursionlimit()
+    if debug:
+        print('Testing parsing of formulas nested', depth, 'levels deep')
+    formula = Formula.parse('~' * depth + 'p')
+    for _ in range(depth):
+        assert formula.root == '~'
+        formula = formula.first
+    assert formula.root == 'p'
+    formula = Formula.parse('(' * depth + 'p' + '&q1)' * depth)
+    for _ in range(depth):
+        assert formula.root == '&' and formula.second.root == 'q1'
+        formula = formula.first
+    assert formula.root == 'p'
+    formula = Formula.parse_polish('|' * depth + 'p' + 'T' * depth)
+    for _ in range(depth):
+        assert formula.root == '|' and formula.second.root == 'T'
+        formula = formula.first
+    assert formula.root == 'p'
+
 # Tests for Chapter 3
 
 def test_repr_all_operators(debug=False):
@@ -321,6 +349,47 @@ def test_substitute_operators(debug=False):
         a = str(f.substitute_operators(frozendict(d)))
         assert a == r, "Incorrect answer:"+a             
                
+def test_substitute_untouched_subformulas(debug=False):
+    formula = Formula.parse('((x&~y)->(z|(T&~x)))')
+    if debug:
+        print('Testing that substitutions in', formula,
+              'keep untouched subformulas')
+    assert formula.substitute_variables({'w': Formula.parse('x')}) is formula
+    assert formula.substitute_operators({'-|': Formula.parse('~(p|q)')}) \
+           is formula
+    substituted = formula.substitute_variables({'z': Formula.parse('~w')})
+    assert str(substituted) == '((x&~y)->(~w|(T&~x)))'
+    assert substituted.first is formula.first
+    assert substituted.second.second is formula.second.second
+    substituted = formula.substitute_operators({'T': Formula.parse('~F')})
+    assert str(substituted) == '((x&~y)->(z|(~F&~x)))'
+    assert substituted.first is formula.first
+
+def test_copy_and_pickle(debug=False):
+    import copy
+    import pickle
+    for infix in ['p', 'T', '~q12', '((x&~y)->(z<->F))']:
+        formula = Formula.parse(infix)
+        if debug:
+            print('Testing copying and pickling of', formula)
+        assert copy.copy(formula) is formula
+        assert copy.deepcopy(formula) is formula
+        assert pickle.loads(pickle.dumps(formula)) is formula
+
+def test_repr_deep(debug=False):
+    depth = 3 * sys.getrecursionlimit() // 10
+    if debug:
+        print('Testing the representation of a formula nested', depth,
+              'levels deep')
+    formula = Formula('p')
+    for _ in range(depth):
+        formula = Formula('&', Formula('q'), formula)
+    assert str(formula) == '(q&' * depth + 'p' + ')' * depth
+    formula = Formula('p')
+    for _ in range(depth):
+        formula = Formula('~', formula)
+    assert str(formula) == '~' * depth + 'p'
+
 def test_ex1(debug=False):
     test_repr(debug)
     test_variables(debug)
@@ -347,4 +416,9 @@ def test_ex3(debug=False):
 def test_all(debug=False):
     test_ex1(debug)
     test_ex1_opt(debug)
-    test_ex3(debug) 
+    test_ex3(debug)
+    test_parse_polish_all_operators(debug)
+    test_parse_deep(debug)
+    test_substitute_untouched_subformulas(debug)
+    test_copy_and_pickle(debug)
+    test_repr_deep(debug)